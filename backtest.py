@@ -1,8 +1,23 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
 import pandas as pd
+import data
+from jit import NUMBA_AVAILABLE, njit, prange
+
+try:
+    import numexpr
+except ImportError:  # numexpr is optional, only used by the NumPy fallback of the backtester kernel
+    numexpr = None
+try:
+    import polars
+except ImportError:  # polars is optional, only needed for backtester(..., backend='polars')
+    polars = None
 
 
-def backtester(price_df, signal_df, spread=0., spread_is_relative=True, allow_shorts=True):
+def backtester(
+        price_df, signal_df, spread=0., spread_is_relative=True, allow_shorts=True, dtype=np.float64, ctx=None,
+        backend='pandas'):
     """
     Backtester prototype
     Execution strategy and PnL calculation:
@@ -14,63 +29,353 @@ def backtester(price_df, signal_df, spread=0., spread_is_relative=True, allow_sh
     mark-to-market returns are calculated using the position held over the bar ('r_position');
     spread costs are charged at execution time based on position changes ('trade') on the current bar.
     Arguments:
-    price_df: DataFrame ('t', 'price')
-    signal_df: DataFrame ('t', 'signal')
-    spread: float OR DataFrame ('t', 'quoted_spread'), default 0.
+    price_df: DataFrame ('t', 'price') OR tuple of arrays (t, price)
+    signal_df: DataFrame ('t', 'signal') OR tuple of arrays (t, signal)
+    spread: float OR DataFrame ('t', 'quoted_spread') OR tuple of arrays (t, quoted_spread), default 0.
+    DataFrame arguments can also be given as dicts of arrays, e.g. a bundle from data.generate_bundle for all three
     spread_is_relative: bool, default True, if False divide spread values by respective price
     allow_shorts: bool, default True, if False the strategy does not open short positions, longs are closed to zero on negative signal instead
+    dtype: float dtype of the per-bar price, spread and return arrays, default np.float64,
+    np.float32 halves memory traffic for long series; equity is always accumulated and returned in float64,
+    'r_position' and 'trade' only take values in {-2, -1, 0, 1, 2} and are always stored as int8
+    ctx: BacktesterContext, default None, preallocated kernel output buffers reused across calls with the same number of bars
+    backend: str, default 'pandas', container of the result:
+    'pandas' - pandas DataFrame,
+    'numpy' - dict of NumPy arrays without any DataFrame construction, the arrays are the ctx buffers if ctx is given,
+    'polars' - polars DataFrame with its own copy of the data, requires polars to be installed
     Returns:
-    return_df: DataFrame ('t', 'price', 'quoted_spread', 'r_position', 'trade', 'net_return', 'equity')
+    return_df: DataFrame OR dict of arrays ('t', 'price', 'quoted_spread', 'r_position', 'trade', 'net_return', 'equity')
     """
+    t, price_values = _unpack_columns(price_df, 'price')
+    price = price_values.astype(dtype, copy=False)
     # Merge prices with signals under condition that the signal timestamp is strictly lower than price timestamp.
-    merged_df = pd.merge_asof(price_df, signal_df, on='t', allow_exact_matches=False, direction='backward')
-    merged_df['signal'].fillna(0, inplace=True)
+    signal_t, signal_values = _unpack_columns(signal_df, 'signal')
+    signal = _merge_asof_values(t, signal_t, signal_values.astype(dtype, copy=False), allow_exact_matches=False)
     # Merge in spread data
-    if np.ndim(spread) > 0:
-        merged_df = pd.merge_asof(merged_df, spread, on='t', allow_exact_matches=True, direction='backward')
-        merged_df['quoted_spread'].fillna(0, inplace=True)
+    if isinstance(spread, (pd.DataFrame, dict, tuple)):
+        spread_t, spread_values = _unpack_columns(spread, 'quoted_spread')
+        quoted_spread = _merge_asof_values(t, spread_t, spread_values.astype(dtype, copy=False), allow_exact_matches=True)
+        has_spread = True
     else:
-        merged_df['quoted_spread'] = spread
-    if not spread_is_relative:
-        merged_df['quoted_spread'] = merged_df['quoted_spread'] / merged_df['price']
+        quoted_spread = np.full(len(price), spread, dtype=dtype)
+        has_spread = spread != 0
+    if has_spread and not spread_is_relative:
+        np.divide(quoted_spread, price, out=quoted_spread)
 
-    merged_df['position'] = np.sign(merged_df['signal']).replace(0, np.nan).ffill().fillna(0)
-    if not allow_shorts:
-        merged_df['position'] = np.where(merged_df['position'] > 0, merged_df['position'], 0)
-    merged_df['trade'] = merged_df['position'].diff(1).fillna(0)
-    # When analyzing return/equity values use positions that created those returns, thus the ones from the prev. bar
-    merged_df['r_position'] = merged_df['position'].shift(1).fillna(0)
-    merged_df['return'] = (merged_df['r_position'] * merged_df['price'].pct_change()).fillna(0)
-    # Unlike mark-to-market returns, spread costs are calculated based on current-bar position update
-    merged_df['spread_return'] = np.abs(merged_df['trade']) * merged_df['quoted_spread'] / 2
-
-    merged_df['net_return'] = merged_df['return'] - merged_df['spread_return']
-    merged_df['equity'] = (1 + merged_df['net_return']).cumprod()
-    
-    return_df = merged_df[['t', 'price', 'quoted_spread', 'r_position', 'trade', 'net_return', 'equity']].copy()
+    if ctx is None:
+        ctx = BacktesterContext(len(price), dtype)
+    elif ctx.n_bars != len(price):
+        raise ValueError(f'BacktesterContext is allocated for {ctx.n_bars} bars, got {len(price)} price bars.')
+    elif ctx.net_return.dtype != dtype:
+        raise ValueError(f'BacktesterContext is allocated for dtype {ctx.net_return.dtype}, got dtype {np.dtype(dtype)}.')
+    if NUMBA_AVAILABLE:
+        kernel = _BACKTEST_KERNELS[bool(has_spread), bool(allow_shorts)]
+        kernel(price, signal, quoted_spread, ctx.r_position, ctx.trade, ctx.net_return, ctx.equity)
+    else:
+        _backtest_numpy(price, signal, quoted_spread, allow_shorts, ctx.r_position, ctx.trade, ctx.net_return, ctx.equity)
+    columns = {
+        't': t,
+        'price': price_values,
+        'quoted_spread': quoted_spread,
+        'r_position': ctx.r_position,
+        'trade': ctx.trade,
+        'net_return': ctx.net_return,
+        'equity': ctx.equity,
+    }
+    if backend == 'numpy':
+        return columns
+    if backend == 'polars':
+        if polars is None:
+            raise ImportError("backend='polars' requires polars to be installed.")
+        # The ctx buffers are copied, so the returned frame is not affected by later calls using the same ctx
+        return polars.DataFrame({name: np.array(values) for name, values in columns.items()})
+    if backend != 'pandas':
+        raise ValueError(f"Unknown backend '{backend}', expected 'pandas', 'numpy' or 'polars'.")
+    # DataFrame construction copies the buffers, so the returned frame is not affected by later calls using the same ctx
+    return_df = pd.DataFrame(columns)
     return return_df
 
 
+class BacktesterContext:
+    """
+    Output buffers of the backtester kernel, allocated once and reused across backtester calls,
+    e.g. when sweeping strategy parameters over the same price series.
+    Arguments:
+    n_bars: int, number of price bars
+    dtype: float dtype of the net return buffer, default np.float64, see backtester
+    """
+
+    def __init__(self, n_bars, dtype=np.float64):
+        self.n_bars = n_bars
+        self.r_position = np.empty(n_bars, dtype=np.int8)
+        self.trade = np.empty(n_bars, dtype=np.int8)
+        self.net_return = np.empty(n_bars, dtype=dtype)
+        self.equity = np.empty(n_bars)
+
+
+def _unpack_columns(data, value_col):
+    """Extract (t, values) arrays from a DataFrame or dict of arrays ('t', value_col) or from a tuple of arrays (t, values)."""
+    if isinstance(data, tuple):
+        t, values = data
+        return np.asarray(t), np.asarray(values)
+    return np.asarray(data['t']), np.asarray(data[value_col])
+
+
+def _merge_asof_values(t, t_other, values_other, allow_exact_matches, fill_value=0.):
+    """
+    Backward as-of lookup of values_other at timestamps t, equivalent to pd.merge_asof(direction='backward') on a single column
+    followed by fillna(fill_value). Both t and t_other have to be sorted, ValueError is raised otherwise as in pd.merge_asof.
+    For each timestamp the last value with t_other < t (t_other <= t if allow_exact_matches) is taken, fill_value if there is none.
+    """
+    for keys, name in [(t, 'left'), (t_other, 'right')]:
+        if (keys[1:] < keys[:-1]).any():
+            raise ValueError(f'{name} keys must be sorted')
+    # Missing source values are filled on the source array, the fill value appended at its end is gathered for idx = -1 (no match)
+    fill_value = values_other.dtype.type(fill_value)
+    values_other = np.append(np.where(np.isnan(values_other), fill_value, values_other), fill_value)
+    dtype = np.promote_types(t.dtype, t_other.dtype)
+    side = 'right' if allow_exact_matches else 'left'
+    idx = np.searchsorted(t_other.astype(dtype, copy=False), t.astype(dtype, copy=False), side=side) - 1
+    return values_other[idx]
+
+
+@njit(cache=True, inline='always')
+def _next_position(s, pos, allow_shorts):
+    """
+    Position state transition for a single bar: take the sign of a non-zero signal, keep the position on zero signal.
+    With allow_shorts=False a negative signal closes the position to zero.
+    """
+    if s > 0:
+        return 1
+    if s < 0:
+        return -1 if allow_shorts else 0
+    return pos
+
+
+def _make_backtest_kernel(has_spread, allow_shorts):
+    """
+    Build a backtester kernel specialized for the given settings.
+    The settings are closure constants for Numba, so the spread cost and the short-position branches
+    are removed from the compiled loop entirely instead of being checked on every bar.
+    """
+    @njit(cache=True, error_model='numpy')
+    def kernel(price, signal, spread, r_position, trade, net_return, equity):
+        """
+        Single-pass computation of position, trade, return and equity arrays for backtester.
+        Position is carried as a scalar and updated with _next_position on every bar.
+        Outputs are written in place into the r_position, trade, net_return and equity arrays,
+        every element is written exactly once, so the buffers do not need to be initialized.
+        Position is an integer and is only promoted to float when multiplied with price returns,
+        the equity is accumulated in float64 regardless of the buffer dtypes.
+        Undefined mark-to-market returns (NaN price bars, a flat position over an infinite price ratio) count as zero.
+        """
+        n = price.shape[0]
+        pos = 0
+        eq = 1.
+        for i in range(n):
+            prev_pos = pos
+            pos = _next_position(signal[i], pos, allow_shorts)
+            if i == 0:
+                # The first bar has neither a previous price nor a previous position to trade from
+                r_position[i] = 0
+                trade[i] = 0
+                net_return[i] = 0.
+                equity[i] = eq
+                continue
+            # When analyzing return/equity values use positions that created those returns, thus the ones from the prev. bar
+            r_position[i] = prev_pos
+            trade[i] = pos - prev_pos
+            net = prev_pos * (price[i] / price[i - 1] - 1)
+            if np.isnan(net):
+                net = 0.
+            if has_spread:
+                # Unlike mark-to-market returns, spread costs are calculated based on current-bar position update
+                net -= abs(pos - prev_pos) * spread[i] / 2
+            eq *= 1 + net
+            net_return[i] = net
+            equity[i] = eq
+
+    return kernel
+
+
+# Kernels keyed by (has_spread, allow_shorts), compiled lazily by Numba on first call
+_BACKTEST_KERNELS = {
+    (has_spread, allow_shorts): _make_backtest_kernel(has_spread, allow_shorts)
+    for has_spread in (False, True) for allow_shorts in (False, True)
+}
+
+
+def _fill_position(signal, allow_shorts):
+    """
+    NumPy version of the _next_position scan: the sign of the last non-zero signal, 0 before the first one.
+    The index of the last non-zero signal is carried forward with np.maximum.accumulate, with no NaN forward fill.
+    """
+    last_idx = np.maximum.accumulate(np.where(signal != 0, np.arange(len(signal)), -1))
+    # Index -1 only occurs before the first non-zero signal and is masked out
+    position = np.where(last_idx >= 0, np.sign(signal)[last_idx], 0).astype(np.int8)
+    if not allow_shorts:
+        np.maximum(position, 0, out=position)
+    return position
+
+
+def _backtest_numpy(price, signal, spread, allow_shorts, r_position, trade, net_return, equity):
+    """NumPy implementation of the backtester kernels used when Numba is not installed, fills the same output arrays in place."""
+    if len(price) == 0:
+        return
+    position = _fill_position(signal, allow_shorts)
+    r_position[0] = 0
+    r_position[1:] = position[:-1]
+    trade[0] = 0
+    np.subtract(position[1:], position[:-1], out=trade[1:])
+    net_return[0] = 0.
+    if numexpr is not None:
+        # numexpr evaluates the whole expression blockwise in one multi-threaded pass, with no full-size temporaries
+        numexpr.evaluate(
+            'r_position * (price / price_prev - 1) - abs(trade) * spread / 2',
+            local_dict={
+                'r_position': r_position[1:], 'price': price[1:], 'price_prev': price[:-1],
+                'trade': trade[1:], 'spread': spread[1:],
+            },
+            out=net_return[1:], casting='same_kind')
+    else:
+        np.divide(price[1:], price[:-1], out=net_return[1:])
+        net_return[1:] -= 1
+        net_return *= r_position
+        net_return -= np.abs(trade) * spread / 2
+    # Undefined mark-to-market returns count as zero as in the kernels, leaving only the spread cost on those bars
+    nan_idx = np.flatnonzero(np.isnan(net_return))
+    if len(nan_idx):
+        net_return[nan_idx] = -np.abs(trade[nan_idx]) * spread[nan_idx] / 2
+    np.add(net_return, 1., out=equity)
+    np.cumprod(equity, out=equity)
+
+
+def batch_backtester(price, signals, spreads=0., allow_shorts=True):
+    """
+    Evaluate K strategies over the same price series at once, returning only their equity curves.
+    Uses the same execution model as backtester, with signals given on the price bars:
+    the signal observed at bar i is executed on bar i + 1, which matches backtester with signal timestamps equal to price timestamps.
+    Strategies are independent and are evaluated in parallel.
+    Arguments:
+    price: array of shape (n_bars,)
+    signals: array of shape (n_bars, K), one column per strategy
+    spreads: float OR array of shape (n_bars,) OR (n_bars, K), relative spread values, default 0.
+    allow_shorts: bool, default True, see backtester
+    Returns:
+    equity: array of shape (n_bars, K)
+    """
+    price = np.asarray(price, dtype=np.float64)
+    # Column-major layout keeps each strategy's bars contiguous in memory
+    signals = np.asfortranarray(signals, dtype=np.float64)
+    spreads = np.asarray(spreads, dtype=np.float64)
+    if spreads.ndim == 1:
+        spreads = spreads[:, None]
+    spreads = np.broadcast_to(spreads, signals.shape)
+    equity = np.empty(signals.shape, order='F')
+    if NUMBA_AVAILABLE:
+        _batch_kernel(price, signals, spreads, allow_shorts, equity)
+    else:
+        _batch_numpy(price, signals, spreads, allow_shorts, equity)
+    return equity
+
+
+@njit(cache=True, error_model='numpy', parallel=True)
+def _batch_kernel(price, signals, spreads, allow_shorts, equity):
+    """Fill the equity array of shape (n_bars, K) in place, one strategy per parallel iteration."""
+    n, k_strategies = signals.shape
+    for k in prange(k_strategies):
+        pos = 0
+        eq = 1.
+        if n > 0:
+            equity[0, k] = eq
+        for i in range(1, n):
+            prev_pos = pos
+            pos = _next_position(signals[i - 1, k], pos, allow_shorts)
+            net = prev_pos * (price[i] / price[i - 1] - 1)
+            if np.isnan(net):
+                net = 0.
+            net -= abs(pos - prev_pos) * spreads[i, k] / 2
+            eq *= 1 + net
+            equity[i, k] = eq
+
+
+def _batch_numpy(price, signals, spreads, allow_shorts, equity):
+    """NumPy implementation of _batch_kernel used when Numba is not installed, one vectorized pass per strategy column."""
+    if len(price) == 0:
+        return
+    price_return = price[1:] / price[:-1] - 1
+    equity[0] = 1.
+    for k in range(signals.shape[1]):
+        # Position held after bar i, set by the signals up to bar i - 1
+        position = _fill_position(signals[:-1, k], allow_shorts)
+        r_position = np.concatenate(([0], position[:-1]))
+        net = r_position * price_return
+        # Undefined mark-to-market returns count as zero as in _batch_kernel
+        net[np.isnan(net)] = 0.
+        net -= np.abs(position - r_position) * spreads[1:, k] / 2
+        net += 1
+        np.cumprod(net, out=equity[1:, k])
+
+
+def run_multi_symbol(
+        symbols, signal_fn, spread=0., spread_is_relative=True, allow_shorts=True, max_workers=None, **load_kwargs):
+    """
+    Run backtester for several symbols in parallel worker processes, one backtest per symbol.
+    Prices are loaded with data.load_hist_data(symbol, **load_kwargs), signals are created as signal_fn(price_df).
+    signal_fn has to be picklable (defined at module level) to be sent to the workers.
+    Arguments:
+    symbols: iterable of stooq symbols, e.g. ['aapl.us', 'msft.us']
+    signal_fn: function DataFrame ('t', 'price') -> DataFrame ('t', 'signal')
+    spread, spread_is_relative, allow_shorts: see backtester
+    max_workers: int, default None, number of worker processes, defaults to the number of CPUs
+    Returns:
+    return_dfs: dict {symbol: return_df}, see backtester
+    """
+    # symbols is iterated again to order the results, so a one-shot iterator is materialized first
+    symbols = list(symbols)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_run_one_symbol, symbol, signal_fn, spread, spread_is_relative, allow_shorts, load_kwargs): symbol
+            for symbol in symbols
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = pd.DataFrame(future.result())
+    return {symbol: results[symbol] for symbol in symbols}
+
+
+def _run_one_symbol(symbol, signal_fn, spread, spread_is_relative, allow_shorts, load_kwargs):
+    """Worker for run_multi_symbol. Results are sent back as a dict of arrays, which is cheaper to pickle than a DataFrame."""
+    price_df = data.load_hist_data(symbol, **load_kwargs)
+    return backtester(price_df, signal_fn(price_df), spread, spread_is_relative, allow_shorts, backend='numpy')
+
+
 def build_trade_pairs(return_df):
     """
     Create opening/closing trade pairs based on DataFrame created by backtester.
     Assumes fixed position size in {-1, 0, 1}, no pyramiding or partial position closing.
     Arguments:
-    return_df: DataFrame containing ('t', 'price', 'quoted_spread', 'trade')
+    return_df: DataFrame OR dict of arrays containing ('t', 'price', 'quoted_spread', 'trade')
     Returns:
     trade_df: DataFrame ('open_t', 'open_price', 'open_pos_change', 'close_t', 'close_price')
     """
-    trade_df = return_df.loc[~np.isclose(return_df['trade'].abs(), 0), ['t', 'price', 'quoted_spread', 'trade']].copy()
-    trade_df['price'] = trade_df['price'] * (1 + np.where(trade_df['trade'] > 0, 1, -1) * trade_df['quoted_spread'] / 2)
-    trade_df.drop('quoted_spread', axis=1, inplace=True)
-    # Any trade of absolute size 2 involves one position closing and one position opening
-    size_one_trades = trade_df[np.isclose(trade_df['trade'].abs(), 1)].copy()
-    size_two_trades = trade_df[np.isclose(trade_df['trade'].abs(), 2)].copy()
-    size_two_trades['trade'] = size_two_trades['trade'] / 2
-    trade_df = pd.concat([size_one_trades, size_two_trades, size_two_trades]).sort_values('t').reset_index(drop=True)
-    assert np.isclose(trade_df['trade'].abs(), 1).all(), 'Unexpected trade size'
-    # Under position assumptions the trades are alternating between opening and closing
-    opening_trade_df = trade_df[::2].rename({'t': 'open_t', 'price': 'open_price', 'trade': 'open_pos_change'}, axis=1).reset_index(drop=True)
-    closing_trade_df = trade_df[1::2].drop('trade', axis=1).rename({'t': 'close_t', 'price': 'close_price'}, axis=1).reset_index(drop=True)
-    trade_df = pd.concat([opening_trade_df, closing_trade_df], axis=1)
+    # Trades are sparse and take exact integer values, so gather the non-zero bars by position instead of masking the frame
+    trade = np.asarray(return_df['trade'])
+    idx = np.flatnonzero(trade)
+    # Any trade of absolute size 2 involves one position closing and one position opening, split it into two unit trades
+    legs = np.where(np.isclose(np.abs(trade[idx]), 2), 2, 1)
+    idx = np.repeat(idx, legs)
+    trade = trade[idx] / np.repeat(legs, legs)
+    assert np.isclose(np.abs(trade), 1).all(), 'Unexpected trade size'
+    price = np.asarray(return_df['price'])[idx] * (1 + np.where(trade > 0, 1, -1) * np.asarray(return_df['quoted_spread'])[idx] / 2)
+    t = np.asarray(return_df['t'])[idx]
+    # Under position assumptions the trades are alternating between opening and closing,
+    # Series alignment leaves the closing columns empty for a position that is still open
+    trade_df = pd.DataFrame({
+        'open_t': pd.Series(t[::2]),
+        'open_price': pd.Series(price[::2]),
+        'open_pos_change': pd.Series(trade[::2]),
+        'close_t': pd.Series(t[1::2]),
+        'close_price': pd.Series(price[1::2]),
+    })
     return trade_df
@@ -1,62 +1,242 @@
+import functools
 import numpy as np
 import pandas as pd
 import pathlib
 
+from jit import NUMBA_AVAILABLE, get_num_threads, njit, prange
 
-def generate_time_range(n_bars, t_start='2025-01-01 06:00:00', t_freq='min'):
+# Parallel kernels only pay off over the vectorized NumPy path with several threads and long enough arrays
+_PARALLEL_MIN_BARS = 100_000
+# Default bar frequency as a Timedelta, date_range then skips resolving the 'min' offset alias on every call
+_ONE_MIN = pd.Timedelta(minutes=1)
+
+
+def generate_time_range(n_bars, t_start='2025-01-01 06:00:00', t_freq=_ONE_MIN):
     """Wrapper function for pd.date_range with consistent argument names."""
     return pd.date_range(periods=n_bars, start=t_start, freq=t_freq)
 
 
+@functools.lru_cache(maxsize=1)
+def _cached_time_range(n_bars, t_start, t_freq):
+    """
+    Memoized generate_time_range, shared by the generators. DatetimeIndex is immutable, so sharing it is safe.
+    Only the last index is kept, which is enough for the generators of one simulation to share it
+    without pinning an index per n_bars value of a sweep in memory.
+    The generators hand out their own copy of the time values, so writing to a returned 't' column or array
+    never modifies the cached index, with or without pandas copy-on-write.
+    """
+    return generate_time_range(n_bars, t_start, t_freq)
+
+
+def fill_normal(rng, out, loc=0., scale=1.):
+    """
+    Fill a preallocated float32 or float64 array with N(loc, scale) values in place and return it.
+    Draws go straight into the buffer, so a sweep can reuse one buffer across iterations instead of allocating per call.
+    """
+    rng.standard_normal(dtype=out.dtype, out=out)
+    if scale != 1:
+        out *= scale
+    if loc != 0:
+        out += loc
+    return out
+
+
+def _generate_prices_array(rng, n_bars, base_price=1.0, return_loc=0, return_scale=0.001, dtype=np.float64):
+    """
+    Generate the price array for generate_random_prices.
+    All steps run in place on a single buffer, from the normal draw to the scaled cumulative product.
+    Returns are scaled and accumulated in float64 for any dtype, so seeded float32 prices are the same on both paths.
+    """
+    prices = fill_normal(rng, np.empty(n_bars, dtype=dtype))
+    if NUMBA_AVAILABLE:
+        if n_bars >= _PARALLEL_MIN_BARS and get_num_threads() > 1:
+            _normals_to_prices_tiled(prices, base_price, return_loc, return_scale, get_num_threads())
+        else:
+            _normals_to_prices(prices, base_price, return_loc, return_scale)
+        return prices
+    # A float64 working buffer only for float32 draws, float64 draws are still transformed in place
+    returns = prices.astype(np.float64, copy=False)
+    returns *= return_scale
+    returns += return_loc
+    np.clip(returns, -0.999, None, out=returns)
+    returns += 1
+    np.cumprod(returns, out=returns)
+    returns *= base_price
+    if returns is not prices:
+        prices[:] = returns
+    return prices
+
+
+@njit(cache=True)
+def _normals_to_prices(z, base_price, return_loc, return_scale):
+    """Turn standard normal draws into prices in place in a single pass, same float64 arithmetic as the NumPy path for any dtype."""
+    acc = 1.
+    for i in range(z.shape[0]):
+        r = max(z[i] * return_scale + return_loc, -0.999)
+        acc *= r + 1
+        z[i] = acc * base_price
+
+
+@njit(cache=True, parallel=True)
+def _normals_to_prices_tiled(z, base_price, return_loc, return_scale, n_tiles):
+    """
+    Parallel prefix product version of _normals_to_prices: each tile is scanned in parallel from 1,
+    the tile totals are chained serially into starting prices, then each tile is rescaled by its starting price in parallel.
+    The reassociated product drifts from the serial scan by rounding only, about 1e-13 relative over a million float64 bars.
+    """
+    n = z.shape[0]
+    tile = (n + n_tiles - 1) // n_tiles
+    totals = np.empty(n_tiles)
+    for k in prange(n_tiles):
+        acc = 1.
+        for i in range(k * tile, min((k + 1) * tile, n)):
+            r = max(z[i] * return_scale + return_loc, -0.999)
+            acc *= r + 1
+            z[i] = acc
+        totals[k] = acc
+    starts = np.empty(n_tiles)
+    start = base_price
+    for k in range(n_tiles):
+        starts[k] = start
+        start *= totals[k]
+    for k in prange(n_tiles):
+        for i in range(k * tile, min((k + 1) * tile, n)):
+            z[i] *= starts[k]
+
+
+def _generate_spreads_array(rng, n_bars, base_spread=0.0002, scale=2, dtype=np.float64):
+    """Generate the spread array for generate_random_spreads, all steps run in place on a single buffer."""
+    spreads = np.empty(n_bars, dtype=dtype)
+    if NUMBA_AVAILABLE and n_bars >= _PARALLEL_MIN_BARS and get_num_threads() > 1:
+        fill_normal(rng, spreads)
+        _normals_to_spreads(spreads, base_spread, scale)
+        return spreads
+    fill_normal(rng, spreads, scale=scale)
+    np.exp(spreads, out=spreads)
+    spreads *= base_spread
+    return spreads
+
+
+@njit(cache=True, parallel=True)
+def _normals_to_spreads(z, base_spread, scale):
+    """
+    Turn standard normal draws into spreads in place, scale, exp and multiply fused into one parallel pass.
+    Compiled exp may differ from NumPy's vectorized exp in the last bit, so results can differ from the NumPy path by an ulp.
+    """
+    for i in prange(z.shape[0]):
+        z[i] = np.exp(z[i] * scale) * base_spread
+
+
+@functools.lru_cache(maxsize=32)
+def _signal_thresholds(p_neg, p_pos):
+    """
+    Validate signal probabilities and convert them to thresholds (t_neg, t_pos) of a uniform draw u:
+    u < t_neg gives -1, u >= t_pos gives 1, 0 otherwise. Memoized for repeated generator calls with the same probabilities.
+    """
+    assert 0 <= p_neg and 0 <= p_pos and p_neg + p_pos <= 1, "Invalid signal probabilities"
+    return p_neg, 1 - p_pos
+
+
+def _side_probs_thresholds(side_probs):
+    """Unpack side_probs as documented in generate_random_signal and return the thresholds from _signal_thresholds."""
+    if isinstance(side_probs, (tuple, list, np.ndarray)):
+        p_neg, p_pos, *_ = side_probs
+    else:
+        p_neg = p_pos = side_probs
+    return _signal_thresholds(float(p_neg), float(p_pos))
+
+
+def _generate_signal_array(rng, n_bars, t_neg, t_pos):
+    """
+    Generate the int8 signal array for generate_random_signal from the thresholds returned by _signal_thresholds.
+    A single uniform draw is compared against the cumulative probabilities of (-1, 0, 1),
+    which yields the same values as rng.choice([-1, 0, 1], p=[p_neg, 1-p_neg-p_pos, p_pos]) for the same generator state.
+    """
+    u = rng.random(n_bars)
+    # Boolean masks are reinterpreted as int8 0/1 without a copy, the two sides never overlap since t_neg <= t_pos
+    return (u >= t_pos).view(np.int8) - (u < t_neg).view(np.int8)
+
+
 def generate_random_prices(
         rng, n_bars, base_price=1.0, return_loc=0, return_scale=0.001,
-        t_start='2025-01-01 06:00:00', t_freq='min'):
+        t_start='2025-01-01 06:00:00', t_freq=_ONE_MIN, return_arrays=False, dtype=np.float64, times=None):
     """
     Generate synthetic price data with normally distributed returns.
     Prices are generated as p_0 = base_price, p_{t+1} = p_t * (1 + r_{t+1}),
     r_1, ..., r_n ~ N(return_loc, return_scale). 
     r_t values are clipped to [-0.999, +infinity).
-    Returns: DataFrame ('t', 'price')
+    dtype can be set to np.float32 to halve memory, normal draws then come from the float32 generator routine.
+    times: precomputed DatetimeIndex of length n_bars, default None, overrides t_start and t_freq
+    Returns: DataFrame ('t', 'price'), or tuple of arrays (t, price) if return_arrays=True
     """
-    returns = rng.normal(size=n_bars, loc=return_loc, scale=return_scale)
-    returns = np.clip(returns, -0.999, None)
-
-    prices = base_price * np.cumprod(returns + 1)
-    times = generate_time_range(n_bars, t_start, t_freq)
-    return pd.DataFrame({'t': times, 'price': prices})
+    prices = _generate_prices_array(rng, n_bars, base_price, return_loc, return_scale, dtype)
+    if times is None:
+        times = _cached_time_range(n_bars, t_start, t_freq)
+    # Only the time values are copied, the freshly allocated prices array is wrapped as is
+    t = times.to_numpy(copy=True)
+    if return_arrays:
+        return t, prices
+    return pd.DataFrame({'t': t, 'price': prices}, copy=False)
 
 
 def generate_random_spreads(
         rng, n_bars, base_spread=0.0002, scale=2,
-        t_start='2025-01-01 06:00:00', t_freq='min'):
+        t_start='2025-01-01 06:00:00', t_freq=_ONE_MIN, return_arrays=False, dtype=np.float64, times=None):
     """
     Generate synthetic spread data as base spread value multiplied by lognormal random value.
     Spreads are generated as spr_t = base_spread * exp(x_t),
     x_1, ..., x_n ~ N(0, scale).
-    Returns: DataFrame ('t', 'quoted_spread')
+    dtype can be set to np.float32 to halve memory, normal draws then come from the float32 generator routine.
+    times: precomputed DatetimeIndex of length n_bars, default None, overrides t_start and t_freq
+    Returns: DataFrame ('t', 'quoted_spread'), or tuple of arrays (t, quoted_spread) if return_arrays=True
     """
-    spreads = base_spread * np.exp(rng.normal(loc=0, scale=scale, size=n_bars))
-    times = generate_time_range(n_bars, t_start, t_freq)
-    return pd.DataFrame({'t': times, 'quoted_spread': spreads})
+    spreads = _generate_spreads_array(rng, n_bars, base_spread, scale, dtype)
+    if times is None:
+        times = _cached_time_range(n_bars, t_start, t_freq)
+    t = times.to_numpy(copy=True)
+    if return_arrays:
+        return t, spreads
+    return pd.DataFrame({'t': t, 'quoted_spread': spreads}, copy=False)
 
 
-def generate_random_signal(rng, n_bars, side_probs=0.1, t_start='2025-01-01 06:00:00', t_freq='min'):
+def generate_random_signal(
+        rng, n_bars, side_probs=0.1, t_start='2025-01-01 06:00:00', t_freq=_ONE_MIN, return_arrays=False, times=None):
     """
     Generate synthetic signal example with each value from {-1, 0, 1}.
     If side_probs is float, P(-1) = P(1) = side_probs.
     If side_probs is an iterable, P(-1) = side_probs[0], P(1) = side_probs[1], additional elements are ignored.
     In both cases P(0) = 1 - P(-1) - P(1).
-    Returns: DataFrame ('t', 'signal')
+    times: precomputed DatetimeIndex of length n_bars, default None, overrides t_start and t_freq
+    Returns: DataFrame ('t', 'signal'), or tuple of arrays (t, signal) if return_arrays=True
     """
-    if isinstance(side_probs, (tuple, list, np.ndarray)):
-        p_neg, p_pos, *_ = side_probs
-    else:
-        p_neg = p_pos = side_probs
-    assert 0 <= p_neg + p_pos <= 1, "Invalid signal probabilities"
+    t_neg, t_pos = _side_probs_thresholds(side_probs)
+
+    signals = _generate_signal_array(rng, n_bars, t_neg, t_pos)
+    if times is None:
+        times = _cached_time_range(n_bars, t_start, t_freq)
+    t = times.to_numpy(copy=True)
+    if return_arrays:
+        return t, signals
+    return pd.DataFrame({'t': t, 'signal': signals}, copy=False)
 
-    signals = rng.choice([-1, 0, 1], p=[p_neg, 1-p_neg-p_pos, p_pos], size=n_bars)
-    times = generate_time_range(n_bars, t_start, t_freq)
-    return pd.DataFrame({'t': times, 'signal': signals})
+
+def generate_bundle(
+        rng, n_bars, base_price=1.0, return_loc=0, return_scale=0.001, side_probs=0.1,
+        base_spread=0.0002, spread_scale=2, t_start='2025-01-01 06:00:00', t_freq=_ONE_MIN, dtype=np.float64):
+    """
+    Generate prices, signals and spreads on one shared time grid as a single dict of arrays.
+    Values are drawn in the order prices, signals, spreads and match calling generate_random_prices,
+    generate_random_signal and generate_random_spreads in that order with the same rng.
+    The bundle can be passed to backtester directly as prices, signals and spread, or wrapped once with pd.DataFrame(bundle).
+    Returns: dict of arrays {'t', 'price', 'signal', 'quoted_spread'}
+    """
+    t_neg, t_pos = _side_probs_thresholds(side_probs)
+    return {
+        't': _cached_time_range(n_bars, t_start, t_freq).to_numpy(copy=True),
+        'price': _generate_prices_array(rng, n_bars, base_price, return_loc, return_scale, dtype),
+        'signal': _generate_signal_array(rng, n_bars, t_neg, t_pos),
+        'quoted_spread': _generate_spreads_array(rng, n_bars, base_spread, spread_scale, dtype),
+    }
 
 
 def load_hist_data(symbol='aapl.us', start_date='20210101', end_date='20250101', cache_dir='data'):
@@ -65,12 +245,16 @@ def load_hist_data(symbol='aapl.us', start_date='20210101', end_date='20250101',
     Stooq is a free public market data provider which does not require authentication.
     The dates are expected to be of format 'YYYYMMDD'.
     Returned prices correspond to daily closing prices.
+    The cache is stored as parquet if pyarrow or fastparquet is installed, as csv otherwise.
     Returns: DataFrame ('t', 'price')
     """
     pathlib.Path(cache_dir).mkdir(exist_ok=True)
-    data_path = f'{cache_dir}/{symbol}_{start_date}_{end_date}.csv'
-    if pathlib.Path(data_path).exists():
-        return pd.read_csv(data_path, parse_dates=['t'])
+    data_path = f'{cache_dir}/{symbol}_{start_date}_{end_date}'
+    # Parquet keeps typed columns and loads without reparsing timestamps, CSV is used when no parquet engine is installed
+    if pathlib.Path(f'{data_path}.parquet').exists():
+        return pd.read_parquet(f'{data_path}.parquet')
+    if pathlib.Path(f'{data_path}.csv').exists():
+        return pd.read_csv(f'{data_path}.csv', parse_dates=['t'])
 
     url = f'https://stooq.pl/q/d/l/?s={symbol}&i=d&f={start_date}&t={end_date}'
     df = pd.read_csv(url, parse_dates=['Data'])
@@ -79,5 +263,8 @@ def load_hist_data(symbol='aapl.us', start_date='20210101', end_date='20250101',
     # Stooq returns column names in Polish. Only the closing price is retained.
     df = df.drop(['Otwarcie', 'Najwyzszy', 'Najnizszy', 'Wolumen'], axis=1).rename({'Data': 't', 'Zamkniecie': 'price'}, axis=1)
     df = df.sort_values('t').reset_index(drop=True)
-    df.to_csv(data_path, index=False)
+    try:
+        df.to_parquet(f'{data_path}.parquet', index=False)
+    except ImportError:  # neither pyarrow nor fastparquet is available
+        df.to_csv(f'{data_path}.csv', index=False)
     return df
@@ -1,39 +1,48 @@
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from matplotlib.collections import LineCollection
 
+from jit import NUMBA_AVAILABLE, njit
 
-# --- Return-based statistics ---
+
+# --- Return-based statistics, return_df can be any backtester result backend ---
 def resulting_equity(return_df):
     """Extract equity value for the final timestamp."""
-    return return_df.iloc[-1]['equity']
+    return np.asarray(return_df['equity'])[-1]
 
 
 def sharpe_ratio(return_df, an_factor=252):
     """Calculate Sharpe Ratio annualized by `an_factor`. Assumes per-bar arithmetic returns."""
-    mu = return_df['net_return'].mean()
-    sigma = return_df['net_return'].std()
+    x = np.asarray(return_df['net_return'], dtype=np.float64)
+    n = len(x)
+    # Both moments from the sum and the sum of squares, without an (x - mu) temporary;
+    # per-bar returns have mu**2 << sigma**2, so the subtraction does not lose precision
+    mu = x.sum() / n
+    sigma = np.sqrt(max(np.dot(x, x) - n * mu * mu, 0.) / (n - 1)) if n > 1 else np.nan
     sharpe = 0 if np.isclose(sigma, 0) else mu / sigma * np.sqrt(an_factor)
     return sharpe
 
 
 def max_drawdown_magn(return_df):
     """Calculate maximum drawdown magnitude of equity curve."""
-    return (return_df['equity'].cummax() - return_df['equity']).max()
+    equity = np.asarray(return_df['equity'])
+    return np.max(np.maximum.accumulate(equity) - equity)
 
 
 def max_drawdown_duration(return_df):
     """Calculate maximum drawdown duration of equity curve, the result is measured in bars."""
-    drawdown_mask = ~np.isclose(return_df['equity'].cummax() - return_df['equity'], 0)
+    equity = np.asarray(return_df['equity'])
+    # Equity is in drawdown exactly when it is strictly below its running maximum
+    drawdown_mask = (equity < np.maximum.accumulate(equity)).astype(np.int8)
     if not np.any(drawdown_mask):
         return 0  # no drawdowns, equity is monotonically rising
     # Add another zero to the end of the array to work around last timestamp being inside the drawdown
-    drawdown_mask = np.array(list(drawdown_mask.astype(int)) + [0])
-    drawdown_mask_diff = drawdown_mask[1:] - drawdown_mask[:-1]
-    diff_index = np.arange(len(drawdown_mask_diff))[drawdown_mask_diff != 0]
+    diff_index = np.flatnonzero(np.diff(np.append(drawdown_mask, np.int8(0))))
     # Guaranteed that diff_index has even length, since we added 0 to the end earlier closing any open drawdown
     # The first value is always not in drawdown since max({x}) = x
-    return np.max(diff_index[1::2] - diff_index[::2])
+    return int(np.max(diff_index[1::2] - diff_index[::2]))
 
 
 def number_of_trades(return_df):
@@ -108,8 +117,16 @@ def assert_pnl_invariant(return_df, trade_df):
     This function computes PnL in price (currency) units, not percentage returns, for internal consistency check.
     The computation is not used for reporting strategy performance, which is evaluated using percentage-based PnL.
     """
-    raw_pnl = (return_df['price'].diff(1) * return_df['r_position']).iloc[1:].sum()
-    spread_pnl = (return_df['trade'].abs() * return_df['price'] * return_df['quoted_spread'] / 2).sum()
+    price = np.asarray(return_df['price'])
+    r_position = np.asarray(return_df['r_position'])
+    trade = np.asarray(return_df['trade'])
+    quoted_spread = np.asarray(return_df['quoted_spread'])
+    if NUMBA_AVAILABLE:
+        raw_pnl, spread_pnl = _pnl_sums(price, r_position, trade, quoted_spread)
+    else:
+        # Bar-to-bar price changes from a single diff over the raw array, no shifted copy of the price column
+        raw_pnl = np.dot(np.diff(price), r_position[1:])
+        spread_pnl = np.sum(np.abs(trade) * price * quoted_spread / 2)
     pnl1 = raw_pnl - spread_pnl
 
     if trade_df.empty:  # if signal is constantly zero
@@ -118,7 +135,7 @@ def assert_pnl_invariant(return_df, trade_df):
         realized_pnl = ((trade_df['close_price'] - trade_df['open_price']) * trade_df['open_pos_change']).dropna().sum()
         pnl2 = realized_pnl
 
-        last_price = return_df.iloc[-1]['price']  # mark the remaining open position to market
+        last_price = price[-1]  # mark the remaining open position to market
         last_trade = trade_df.iloc[-1]
         if pd.isna(last_trade['close_t']):
             pnl2 += last_trade['open_pos_change'] * (last_price - last_trade['open_price'])
@@ -126,20 +143,94 @@ def assert_pnl_invariant(return_df, trade_df):
     assert np.isclose(pnl1, pnl2), f'PnL mismatch, pnl1={pnl1}, pnl2={pnl2}'
 
 
+@njit(cache=True)
+def _pnl_sums(price, r_position, trade, quoted_spread):
+    """Bar-based mark-to-market PnL and spread cost in price units, both summed in one pass over the arrays."""
+    raw_pnl = 0.
+    spread_pnl = 0.
+    for i in range(price.shape[0]):
+        if i > 0:
+            raw_pnl += (price[i] - price[i - 1]) * r_position[i]
+        spread_pnl += abs(trade[i]) * price[i] * quoted_spread[i] / 2
+    return raw_pnl, spread_pnl
+
+
 # --- Visualization ---
 def draw_results(ax, ax2, return_df, price_df, fig_title=None):
     """
     Draw equity curve and shade position sides into ax based on return_df.
-    Draw background price curve into ax2 based on price_df.
+    Draw background price curve based on price_df into ax2, or, if ax2 is None,
+    into ax rescaled to the equity range and labeled on a secondary y-axis, which avoids a twinx Axes.
     """
-    ax.plot(return_df['t'], return_df['equity'])
+    t = np.asarray(return_df['t'])
+    equity = np.asarray(return_df['equity'], dtype=np.float64)
+    idx = _plot_indices(ax, equity)
+    ax.plot(t[idx], equity[idx])
+    # One broken_barh artist per side with a bar per position run, instead of fill_between over every bar.
+    # Like axvspan, bars span the full axes height in axes coordinates, so they leave the equity y-limits alone
+    starts, ends, sides = _position_runs(return_df['r_position'])
+    for side, color in [(1, 'green'), (-1, 'red')]:
+        run_starts, run_ends = starts[sides == side], ends[sides == side]
+        ax.broken_barh(list(zip(t[run_starts], t[run_ends] - t[run_starts])), (0, 1),
+                       transform=ax.get_xaxis_transform(), color=color, alpha=0.15)
     ymin, ymax = ax.get_ylim()
-    ax.fill_between(return_df['t'], ymin, ymax, where=(return_df['r_position'] > 0), color='green', alpha=0.15)
-    ax.fill_between(return_df['t'], ymin, ymax, where=(return_df['r_position'] < 0), color='red', alpha=0.15)
-    ax.set_ylim(ymin, ymax)
     ax.set_ylabel('Equity')
     if fig_title is not None:
         ax.set_title(fig_title)
-    
-    ax2.plot(price_df['t'], price_df['price'], c='black', alpha=0.3)
-    ax2.set_ylabel('Price')
+
+    price_ax = ax if ax2 is None else ax2
+    price = np.asarray(price_df['price'], dtype=np.float64)
+    idx = _plot_indices(price_ax, price)
+    price_t, price = np.asarray(price_df['t'])[idx], price[idx]
+    if ax2 is not None:
+        ax2.plot(price_t, price, c='black', alpha=0.3)
+        ax2.set_ylabel('Price')
+        return
+
+    # Price mapped linearly from [pmin, pmax] onto the equity range [ymin, ymax], NaN price bars are left as gaps in the line
+    finite_price = price[np.isfinite(price)]
+    pmin, pmax = (finite_price.min(), finite_price.max()) if len(finite_price) else (0., 0.)
+    scale = (ymax - ymin) / (pmax - pmin) if pmax > pmin else 1.
+    # The whole curve is a single polyline in one collection, added without touching the equity data limits
+    line = np.column_stack((mdates.date2num(price_t), ymin + (price - pmin) * scale))
+    ax.add_collection(LineCollection([line], colors='black', alpha=0.3), autolim=False)
+    price_axis = ax.secondary_yaxis(
+        'right', functions=(lambda y: pmin + (y - ymin) / scale, lambda p: ymin + (p - pmin) * scale))
+    price_axis.set_ylabel('Price')
+
+
+def _plot_stride(ax, n_points):
+    """Step between plotted points so that a line has at most about two points per horizontal pixel of the figure."""
+    fig = ax.get_figure()
+    max_points = int(fig.get_size_inches()[0] * fig.dpi * 2)
+    return max(1, n_points // max_points)
+
+
+def _plot_indices(ax, y):
+    """
+    Indices of the points of y to plot, in increasing order: the lowest and the highest point of each bucket of bars,
+    the first and the last point, and every point after the last full bucket.
+    Buckets span two plot strides, so a line keeps about two points per horizontal pixel without dropping extremes or its end.
+    """
+    n = len(y)
+    bucket = 2 * _plot_stride(ax, n)
+    if bucket == 2 or n <= bucket:
+        return np.arange(n)
+    n_buckets = n // bucket
+    buckets = y[:n_buckets * bucket].reshape(n_buckets, bucket)
+    offsets = np.arange(n_buckets) * bucket
+    return np.unique(np.concatenate((
+        [0, n - 1], offsets + np.argmin(buckets, axis=1), offsets + np.argmax(buckets, axis=1),
+        np.arange(n_buckets * bucket, n))))
+
+
+def _position_runs(r_position):
+    """
+    Run-length encode position sides.
+    Returns: arrays (starts, ends, sides), first and last bar index (inclusive) and sign of each run of constant position side
+    """
+    sides = np.sign(np.asarray(r_position))
+    change_index = np.flatnonzero(np.diff(sides)) + 1
+    starts = np.concatenate(([0], change_index))[:len(sides)]
+    ends = np.concatenate((change_index - 1, [len(sides) - 1]))[:len(sides)]
+    return starts, ends, sides[starts]
@@ -0,0 +1,16 @@
+# Numba is optional: without it njit leaves functions as plain Python and prange falls back to range,
+# NUMBA_AVAILABLE lets callers switch hot paths to their NumPy implementations instead.
+try:
+    from numba import get_num_threads, njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def get_num_threads():
+        """Stand-in for numba.get_num_threads, plain Python runs on a single thread."""
+        return 1
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit(...) used as a decorator factory, returns the function unchanged."""
+        return lambda func: func